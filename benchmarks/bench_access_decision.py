@@ -0,0 +1,86 @@
+"""Statements per metered call and p50/p99 latency, before vs after the
+single-query access decision.
+
+"before" replays the original sequence used by ``/services/{service_name}``:
+get_permission_by_endpoint, get_subscription, a plan_permissions lookup and a
+usage lookup inside check_access, a second get_permission_by_endpoint, then
+the read-modify-write track_usage. "after" is the current call_service path:
+authorize, served from the policy cache, followed by the atomic track_usage.
+
+    python benchmarks/bench_access_decision.py [iterations]
+"""
+import asyncio
+import json
+import sys
+
+from common import StatementCounter, import_main_in_tempdir, summarize, timed
+
+main = import_main_in_tempdir()
+db = main.database
+
+
+async def legacy_call(user_id, endpoint):
+    perm = await main.get_permission_by_endpoint(endpoint)
+    if not perm:
+        raise LookupError(endpoint)
+    sub = await main.get_subscription(user_id)
+    if not sub:
+        return False
+    plan_perm = await db.fetch_one(main.plan_permissions.select().where(
+        (main.plan_permissions.c.plan_id == sub.plan_id) &
+        (main.plan_permissions.c.permission_id == perm.id)))
+    if not plan_perm:
+        return False
+    usage_row = await db.fetch_one(main.usage.select().where(
+        (main.usage.c.user_id == user_id) & (main.usage.c.permission_id == perm.id)))
+    used = usage_row['count'] if usage_row else 0
+    if used >= plan_perm['limit']:
+        return False
+    perm = await main.get_permission_by_endpoint(endpoint)
+    # original read-modify-write track_usage
+    row = await db.fetch_one(main.usage.select().where(
+        (main.usage.c.user_id == user_id) & (main.usage.c.permission_id == perm['id'])))
+    if row:
+        await db.execute(main.usage.update().where(
+            (main.usage.c.user_id == user_id) & (main.usage.c.permission_id == perm['id'])
+        ).values(count=row['count'] + 1))
+    else:
+        await db.execute(main.usage.insert().values(user_id=user_id, permission_id=perm['id'], count=1))
+    return True
+
+
+async def compiled_call(user_id, endpoint):
+    reason, perm_id, limit = await main.authorize(user_id, endpoint)
+    return reason is None and await main.track_usage(user_id, perm_id, limit)
+
+
+async def seed(users):
+    perm_id = await db.execute(main.permissions.insert().values(
+        name="bench", endpoint="service1", description=""))
+    plan_id = await db.execute(main.plans.insert().values(name="bench", description=""))
+    await db.execute(main.plan_permissions.insert().values(
+        plan_id=plan_id, permission_id=perm_id, limit=10 ** 9))
+    for user_id in users:
+        await db.execute(main.subscriptions.insert().values(user_id=user_id, plan_id=plan_id))
+
+
+async def run(iterations):
+    await db.connect()
+    legacy_users, compiled_users = range(1, 51), range(51, 101)
+    await seed(list(legacy_users) + list(compiled_users))
+    results = {}
+    for label, fn, users in (("before", legacy_call, legacy_users),
+                             ("after", compiled_call, compiled_users)):
+        users = list(users)
+        with StatementCounter(db) as counter:
+            latencies = await timed(lambda i: fn(users[i % len(users)], "service1"), iterations)
+        results[label] = dict(summarize(latencies),
+                              statements_per_request=round(counter.count / iterations, 2))
+    results["policy_cache"] = main.policy_cache.stats()
+    await db.disconnect()
+    return results
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print(json.dumps(asyncio.run(run(iterations)), indent=2))
@@ -0,0 +1,76 @@
+"""Metered-call throughput with synchronous usage writes vs the write-behind
+usage buffer.
+
+Each mode drives authorize + track_usage (the /services/{service_name} path)
+for a set of users at a fixed concurrency and reports calls per second.
+
+    python benchmarks/bench_write_behind.py [calls] [concurrency]
+"""
+import asyncio
+import json
+import sys
+import time
+
+import sqlalchemy
+
+from common import import_main_in_tempdir
+
+main = import_main_in_tempdir()
+db = main.database
+
+
+async def seed(users):
+    perm_id = await db.execute(main.permissions.insert().values(
+        name="bench", endpoint="service1", description=""))
+    plan_id = await db.execute(main.plans.insert().values(name="bench", description=""))
+    await db.execute(main.plan_permissions.insert().values(
+        plan_id=plan_id, permission_id=perm_id, limit=10 ** 9))
+    for user_id in users:
+        await db.execute(main.subscriptions.insert().values(user_id=user_id, plan_id=plan_id))
+
+
+async def drive(users, calls, concurrency):
+    gate = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with gate:
+            user_id = users[i % len(users)]
+            reason, perm_id, limit = await main.authorize(user_id, "service1")
+            assert reason is None and await main.track_usage(user_id, perm_id, limit)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(calls)))
+    return time.perf_counter() - start
+
+
+async def run(calls, concurrency):
+    await db.connect()
+    sync_users, buffered_users = list(range(1, 101)), list(range(101, 201))
+    await seed(sync_users + buffered_users)
+    results = {}
+
+    elapsed = await drive(sync_users, calls, concurrency)
+    results["synchronous"] = {"calls": calls, "seconds": round(elapsed, 3),
+                              "calls_per_s": round(calls / elapsed, 1)}
+
+    main.usage_buffer.enabled = True
+    main.usage_buffer.start()
+    elapsed = await drive(buffered_users, calls, concurrency)
+    await main.usage_buffer.stop()
+    results["write_behind"] = {"calls": calls, "seconds": round(elapsed, 3),
+                               "calls_per_s": round(calls / elapsed, 1),
+                               "interval_ms": main.usage_buffer.interval_ms,
+                               "batch_size": main.usage_buffer.batch_size,
+                               **main.usage_buffer.stats()}
+
+    stored = await db.fetch_val(sqlalchemy.select(sqlalchemy.func.sum(main.usage.c.count))
+                                .where(main.usage.c.user_id.in_(buffered_users)))
+    results["write_behind"]["stored_after_drain"] = stored
+    await db.disconnect()
+    return results
+
+
+if __name__ == "__main__":
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    print(json.dumps(asyncio.run(run(calls, concurrency)), indent=2))
@@ -0,0 +1,77 @@
+"""Shared helpers for the benchmark scripts.
+
+Benchmarks import ``main`` from a throwaway working directory so that the
+relative ``sqlite:///./cloud_access.db`` URL never touches the real database.
+"""
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def import_main_in_tempdir():
+    """chdir into a fresh temp directory and import main against it."""
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    import main
+    return main
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(latencies_s):
+    """p50/p99/mean in milliseconds for a list of latencies in seconds."""
+    ms = [x * 1000.0 for x in latencies_s]
+    return {
+        "n": len(ms),
+        "p50_ms": round(percentile(ms, 50), 4),
+        "p99_ms": round(percentile(ms, 99), 4),
+        "mean_ms": round(statistics.fmean(ms), 4) if ms else 0.0,
+    }
+
+
+class StatementCounter:
+    """Counts statements issued through a ``databases.Database`` instance."""
+
+    METHODS = ("fetch_one", "fetch_all", "fetch_val", "execute", "execute_many")
+
+    def __init__(self, database):
+        self.database = database
+        self.count = 0
+        self._originals = {}
+
+    def __enter__(self):
+        for name in self.METHODS:
+            original = getattr(self.database, name)
+            self._originals[name] = original
+
+            async def wrapper(*args, __original=original, **kwargs):
+                self.count += 1
+                return await __original(*args, **kwargs)
+
+            setattr(self.database, name, wrapper)
+        return self
+
+    def __exit__(self, *exc):
+        for name in self.METHODS:
+            delattr(self.database, name)
+        return False
+
+
+async def timed(coro_factory, iterations):
+    latencies = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        await coro_factory(i)
+        latencies.append(time.perf_counter() - start)
+    return latencies
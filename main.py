@@ -1,13 +1,31 @@
 import uvicorn
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
 import sqlalchemy
 import databases
 from pydantic import BaseModel, Field, validator
 from typing import List, Optional, Union
+from collections import OrderedDict
+import asyncio
+import json
+import logging
+import os
 import sqlite3
 
+logger = logging.getLogger(__name__)
+
 # Database configuration
 DATABASE_URL = "sqlite:///./cloud_access.db"
+
+# Records per set-based pass of the bulk usage endpoint
+USAGE_BATCH_CHUNK_SIZE = 1000
+
+# Write-behind usage counting: increments are buffered in memory and flushed
+# in one batched UPSERT every USAGE_FLUSH_INTERVAL_MS or USAGE_FLUSH_BATCH_SIZE
+# increments, whichever comes first.
+USAGE_WRITE_BEHIND = os.environ.get("USAGE_WRITE_BEHIND", "0") == "1"
+USAGE_FLUSH_INTERVAL_MS = int(os.environ.get("USAGE_FLUSH_INTERVAL_MS", "50"))
+USAGE_FLUSH_BATCH_SIZE = int(os.environ.get("USAGE_FLUSH_BATCH_SIZE", "500"))
 database = databases.Database(DATABASE_URL)
 metadata = sqlalchemy.MetaData()
 
@@ -92,16 +110,49 @@ class SubscribeRequest(BaseModel):
 class UsageRequest(BaseModel):
     endpoint: str
 
+class UsageRecord(BaseModel):
+    user_id: int
+    endpoint: str
+    count: int = Field(1, ge=1)
+
 # Application startup/shutdown events
 @app.on_event("startup")
 async def startup():
     await database.connect()
+    if usage_buffer.enabled:
+        usage_buffer.start()
 
 @app.on_event("shutdown")
 async def shutdown():
+    await usage_buffer.stop()
     await database.disconnect()
 
 # Helper functions
+async def iter_ndjson(request: Request):
+    """Yield one parsed value per non-blank line of a streamed NDJSON body.
+
+    Lines that are not valid JSON yield None.
+    """
+    pending = b""
+    async for chunk in request.stream():
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield _parse_json_line(line)
+    if pending.strip():
+        yield _parse_json_line(pending)
+
+def _parse_json_line(line: bytes):
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+def is_ndjson(request: Request) -> bool:
+    return request.headers.get("content-type", "").split(";")[0].strip() in (
+        "application/x-ndjson", "application/jsonl", "application/ndjson")
+
 async def get_plan(plan_id: int):
     return await database.fetch_one(plans.select().where(plans.c.id == plan_id))
 
@@ -114,50 +165,299 @@ async def get_permission_by_endpoint(endpoint: str):
 async def get_subscription(user_id: int):
     return await database.fetch_one(subscriptions.select().where(subscriptions.c.user_id == user_id))
 
-async def check_access(user_id: int, endpoint: str):
-    perm = await get_permission_by_endpoint(endpoint)
-    if not perm:
-        raise HTTPException(status_code=404, detail="Permission not found for endpoint")
-    sub = await get_subscription(user_id)
-    if not sub:
-        return False, "No subscription"
-    plan_perm = await database.fetch_one(
-        plan_permissions.select().where(
-            (plan_permissions.c.plan_id == sub.plan_id) &
-            (plan_permissions.c.permission_id == perm.id)
-        )
-    )
-    if not plan_perm:
-        return False, "Endpoint not in plan permissions"
-    usage_row = await database.fetch_one(
-        usage.select().where(
-            (usage.c.user_id == user_id) &
-            (usage.c.permission_id == perm.id)
-        )
-    )
-    used = usage_row['count'] if usage_row else 0
-    if used >= plan_perm['limit']:
-        return False, "Usage limit reached"
-    return True, None
-
-async def track_usage(user_id: int, perm_id: int):
-    row = await database.fetch_one(
-        usage.select().where(
-            (usage.c.user_id == user_id) &
-            (usage.c.permission_id == perm_id)
-        )
-    )
-    if row:
-        new_count = row['count'] + 1
-        await database.execute(
-            usage.update()
-                  .where((usage.c.user_id == user_id) & (usage.c.permission_id == perm_id))
-                  .values(count=new_count)
+class PolicyCache:
+    """In-process cache of the policy tables read on every metered request.
+
+    Holds endpoint -> permission_id, plan_id -> {permission_id: limit} and an
+    LRU-bounded user_id -> plan_id map. Management endpoints invalidate the
+    entries they change; a load racing with an invalidation is not stored.
+    """
+
+    def __init__(self, max_users: int = 10000):
+        self.max_users = max_users
+        self.endpoints = {}
+        self.plans = {}
+        self.users = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._generation = 0
+
+    async def permission_id(self, endpoint: str) -> Optional[int]:
+        if endpoint in self.endpoints:
+            self.hits += 1
+            return self.endpoints[endpoint]
+        self.misses += 1
+        generation = self._generation
+        perm = await get_permission_by_endpoint(endpoint)
+        if not perm:
+            return None
+        if generation == self._generation:
+            self.endpoints[endpoint] = perm['id']
+        return perm['id']
+
+    async def plan_limits(self, plan_id: int) -> dict:
+        if plan_id in self.plans:
+            self.hits += 1
+            return self.plans[plan_id]
+        self.misses += 1
+        generation = self._generation
+        rows = await database.fetch_all(
+            plan_permissions.select().where(plan_permissions.c.plan_id == plan_id)
         )
-    else:
-        await database.execute(
-            usage.insert().values(user_id=user_id, permission_id=perm_id, count=1)
+        limits = {row['permission_id']: row['limit'] for row in rows}
+        if generation == self._generation:
+            self.plans[plan_id] = limits
+        return limits
+
+    async def user_plan(self, user_id: int) -> Optional[int]:
+        if user_id in self.users:
+            self.hits += 1
+            self.users.move_to_end(user_id)
+            return self.users[user_id]
+        self.misses += 1
+        generation = self._generation
+        sub = await get_subscription(user_id)
+        plan_id = sub['plan_id'] if sub else None
+        if generation == self._generation:
+            self.users[user_id] = plan_id
+            if len(self.users) > self.max_users:
+                self.users.popitem(last=False)
+        return plan_id
+
+    def invalidate_endpoint(self, *endpoints: str):
+        self._generation += 1
+        for endpoint in endpoints:
+            self.endpoints.pop(endpoint, None)
+
+    def invalidate_plan(self, plan_id: int):
+        self._generation += 1
+        self.plans.pop(plan_id, None)
+
+    def invalidate_permission(self, permission_id: int):
+        """Drop the permission's endpoint and every cached plan that grants it."""
+        self._generation += 1
+        for endpoint, perm_id in list(self.endpoints.items()):
+            if perm_id == permission_id:
+                del self.endpoints[endpoint]
+        for plan_id, limits in list(self.plans.items()):
+            if permission_id in limits:
+                del self.plans[plan_id]
+
+    def invalidate_user(self, user_id: int):
+        self._generation += 1
+        self.users.pop(user_id, None)
+
+    def clear(self):
+        self._generation += 1
+        self.endpoints.clear()
+        self.plans.clear()
+        self.users.clear()
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'endpoints': len(self.endpoints),
+            'plans': len(self.plans),
+            'users': len(self.users),
+        }
+
+policy_cache = PolicyCache()
+
+async def authorize(user_id: int, endpoint: str):
+    """Policy half of the access decision, served from policy_cache.
+
+    Returns (reason, permission_id, limit); reason is None when the user's
+    plan grants the endpoint.
+    """
+    perm_id = await policy_cache.permission_id(endpoint)
+    if perm_id is None:
+        raise HTTPException(status_code=404, detail="Permission not found for endpoint")
+    plan_id = await policy_cache.user_plan(user_id)
+    if plan_id is None:
+        return "No subscription", perm_id, None
+    limits = await policy_cache.plan_limits(plan_id)
+    if perm_id not in limits:
+        return "Endpoint not in plan permissions", perm_id, None
+    return None, perm_id, limits[perm_id]
+
+async def get_usage_count(user_id: int, perm_id: int) -> int:
+    """Stored count plus any increments still waiting in usage_buffer."""
+    while True:
+        flushes = usage_buffer.flushes
+        row = await database.fetch_one(
+            usage.select().where(
+                (usage.c.user_id == user_id) &
+                (usage.c.permission_id == perm_id)
+            )
         )
+        # a flush that committed while we were reading would be counted
+        # neither in the row nor in the buffer, so read again
+        if flushes == usage_buffer.flushes:
+            return (row['count'] if row else 0) + usage_buffer.unflushed(user_id, perm_id)
+
+async def resolve_access(user_id: int, endpoint: str):
+    """Return (allowed, reason, permission_id) for user_id calling endpoint."""
+    reason, perm_id, limit = await authorize(user_id, endpoint)
+    if reason:
+        return False, reason, perm_id
+    if await get_usage_count(user_id, perm_id) >= limit:
+        return False, "Usage limit reached", perm_id
+    return True, None, perm_id
+
+async def check_access(user_id: int, endpoint: str):
+    allowed, reason, _ = await resolve_access(user_id, endpoint)
+    return allowed, reason
+
+# Consume one unit of quota if, and only if, the stored count is still under
+# the plan limit. The insert covers the first call, the guarded update every
+# later one; a returned row means the unit was consumed.
+consume_usage = sqlalchemy.text("""
+    INSERT INTO usage (user_id, permission_id, count)
+    SELECT :user_id, :permission_id, 1 WHERE :limit > 0
+    ON CONFLICT (user_id, permission_id) DO UPDATE SET count = usage.count + 1
+    WHERE usage.count < :limit
+    RETURNING count
+""")
+
+def upsert_usage_deltas(keys: List[tuple]):
+    """One multi-row UPSERT adding each (user_id, permission_id, delta)."""
+    rows = ", ".join(f"(:u{i}, :p{i}, :d{i})" for i in range(len(keys)))
+    values = {}
+    for i, (user_id, perm_id, delta) in enumerate(keys):
+        values.update({f"u{i}": user_id, f"p{i}": perm_id, f"d{i}": delta})
+    return sqlalchemy.text(f"""
+        INSERT INTO usage (user_id, permission_id, count) VALUES {rows}
+        ON CONFLICT (user_id, permission_id) DO UPDATE SET count = usage.count + excluded.count
+    """).bindparams(**values)
+
+async def apply_usage_deltas(deltas: dict, chunk_size: int = 300):
+    """Add {(user_id, permission_id): delta} to the stored counts in one transaction."""
+    items = [(user_id, perm_id, delta) for (user_id, perm_id), delta in deltas.items() if delta]
+    async with database.transaction():
+        for i in range(0, len(items), chunk_size):
+            await database.execute(upsert_usage_deltas(items[i:i + chunk_size]))
+
+class UsageBuffer:
+    """Write-behind buffer for usage increments.
+
+    When enabled, track_usage records increments in an in-memory map keyed by
+    (user_id, permission_id) instead of writing each one. A background task
+    flushes the map with apply_usage_deltas every interval_ms, or sooner once
+    batch_size increments are waiting. Deltas stay visible to limit checks,
+    through unflushed(), until their flush has committed.
+    """
+
+    def __init__(self, enabled: bool = False, interval_ms: int = 50, batch_size: int = 500):
+        self.enabled = enabled
+        self.interval_ms = interval_ms
+        self.batch_size = batch_size
+        self.pending = {}
+        self.inflight = {}
+        self.waiting = 0
+        self.flushes = 0
+        self.flushed_increments = 0
+        self._task = None
+        self._wake = None
+        self._lock = None
+
+    def unflushed(self, user_id: int, perm_id: int) -> int:
+        key = (user_id, perm_id)
+        return self.pending.get(key, 0) + self.inflight.get(key, 0)
+
+    async def consume(self, user_id: int, perm_id: int, limit: int) -> bool:
+        if await get_usage_count(user_id, perm_id) >= limit:
+            return False
+        # no await between the limit check and the increment
+        self.add((user_id, perm_id), 1)
+        return True
+
+    def add(self, key: tuple, delta: int):
+        self.pending[key] = self.pending.get(key, 0) + delta
+        self.waiting += delta
+        if self.waiting >= self.batch_size and self._wake is not None:
+            self._wake.set()
+
+    async def flush(self) -> int:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if not self.pending:
+                return 0
+            self.inflight, self.pending = self.pending, {}
+            self.waiting = 0
+            try:
+                await apply_usage_deltas(self.inflight)
+            except Exception:
+                for key, delta in self.inflight.items():
+                    self.pending[key] = self.pending.get(key, 0) + delta
+                self.waiting += sum(self.inflight.values())
+                self.inflight = {}
+                raise
+            flushed = sum(self.inflight.values())
+            self.inflight = {}
+            self.flushes += 1
+            self.flushed_increments += flushed
+            return flushed
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval_ms / 1000)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("usage flush failed; increments kept for the next flush")
+
+    def start(self):
+        if self._task is None:
+            self._wake = asyncio.Event()
+            self._lock = asyncio.Lock()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the flush task and drain whatever is still buffered."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self._wake = None
+        await self.flush()
+        self._lock = None
+
+    def stats(self) -> dict:
+        return {
+            'pending': sum(self.pending.values()),
+            'flushes': self.flushes,
+            'flushed_increments': self.flushed_increments,
+        }
+
+usage_buffer = UsageBuffer(
+    enabled=USAGE_WRITE_BEHIND,
+    interval_ms=USAGE_FLUSH_INTERVAL_MS,
+    batch_size=USAGE_FLUSH_BATCH_SIZE,
+)
+
+async def track_usage(user_id: int, perm_id: int, limit: Optional[int] = None):
+    """Atomically consume one call; returns False if the limit is already reached.
+
+    limit defaults to the user's current plan limit for perm_id.
+    """
+    if limit is None:
+        plan_id = await policy_cache.user_plan(user_id)
+        limit = (await policy_cache.plan_limits(plan_id)).get(perm_id) if plan_id is not None else None
+        if limit is None:
+            return False
+    if usage_buffer.enabled:
+        return await usage_buffer.consume(user_id, perm_id, limit)
+    row = await database.fetch_one(consume_usage.bindparams(user_id=user_id, permission_id=perm_id, limit=limit))
+    return row is not None
 
 # Management APIs
 @app.post("/plans")
@@ -176,6 +476,7 @@ async def create_plan(payload: PlanCreate):
                 plan_id=plan_id, permission_id=perm_id, limit=limit
             )
         )
+    policy_cache.invalidate_plan(plan_id)
     return {"id": plan_id}
 
 @app.put("/plans/{plan_id}")
@@ -197,12 +498,14 @@ async def modify_plan(plan_id: int, payload: PlanUpdate):
                     plan_id=plan_id, permission_id=perm_id, limit=limit
                 )
             )
+    policy_cache.invalidate_plan(plan_id)
     return {"status": "updated"}
 
 @app.delete("/plans/{plan_id}")
 async def delete_plan(plan_id: int):
     await database.execute(plan_permissions.delete().where(plan_permissions.c.plan_id == plan_id))
     await database.execute(plans.delete().where(plans.c.id == plan_id))
+    policy_cache.invalidate_plan(plan_id)
     return {"status": "deleted"}
 
 @app.post("/permissions")
@@ -213,23 +516,27 @@ async def add_permission(payload: PermissionCreate):
         ))
     except sqlite3.IntegrityError:
         raise HTTPException(status_code=400, detail="Permission name or endpoint must be unique")
+    policy_cache.invalidate_endpoint(payload.endpoint)
     return {"id": perm_id}
 
 @app.put("/permissions/{permission_id}")
 async def modify_permission(permission_id: int, payload: PermissionUpdate):
-    if not await get_permission_by_id(permission_id):
+    perm = await get_permission_by_id(permission_id)
+    if not perm:
         raise HTTPException(status_code=404, detail="Permission not found")
     update_data = {k: v for k, v in payload.dict().items() if v is not None}
     if update_data:
         await database.execute(
             permissions.update().where(permissions.c.id == permission_id).values(**update_data)
         )
+        policy_cache.invalidate_endpoint(perm['endpoint'], update_data.get('endpoint', perm['endpoint']))
     return {"status": "updated"}
 
 @app.delete("/permissions/{permission_id}")
 async def delete_permission(permission_id: int):
     await database.execute(plan_permissions.delete().where(plan_permissions.c.permission_id == permission_id))
     await database.execute(permissions.delete().where(permissions.c.id == permission_id))
+    policy_cache.invalidate_permission(permission_id)
     return {"status": "deleted"}
 
 # Subscription APIs
@@ -240,6 +547,7 @@ async def subscribe(payload: SubscribeRequest):
     await database.execute(subscriptions.insert().values(
         user_id=payload.user_id, plan_id=payload.plan_id
     ))
+    policy_cache.invalidate_user(payload.user_id)
     return {"status": "subscribed"}
 
 @app.put("/subscriptions/{user_id}")
@@ -249,6 +557,7 @@ async def modify_subscription(user_id: int, payload: SubscribeRequest):
     await database.execute(
         subscriptions.update().where(subscriptions.c.user_id == user_id).values(plan_id=payload.plan_id)
     )
+    policy_cache.invalidate_user(user_id)
     return {"status": "updated"}
 
 @app.get("/subscriptions/{user_id}")
@@ -291,10 +600,14 @@ async def view_usage(user_id: int):
     if not await get_subscription(user_id):
         raise HTTPException(status_code=404, detail="Subscription not found")
     rows = await database.fetch_all(usage.select().where(usage.c.user_id == user_id))
+    counts = {row['permission_id']: row['count'] for row in rows}
+    for uid, perm_id in list(usage_buffer.pending) + list(usage_buffer.inflight):
+        if uid == user_id:
+            counts.setdefault(perm_id, 0)
     result = []
-    for row in rows:
-        perm = await get_permission_by_id(row['permission_id'])
-        result.append({'endpoint': perm['endpoint'], 'count': row['count']})
+    for perm_id, count in counts.items():
+        perm = await get_permission_by_id(perm_id)
+        result.append({'endpoint': perm['endpoint'], 'count': count + usage_buffer.unflushed(user_id, perm_id)})
     return {'user_id': user_id, 'usage': result}
 
 @app.get("/access/{user_id}/{endpoint}")
@@ -302,17 +615,146 @@ async def access_control(user_id: int, endpoint: str):
     allowed, reason = await check_access(user_id, endpoint)
     return {'user_id': user_id, 'endpoint': endpoint, 'access': allowed, 'reason': reason}
 
+async def read_usage_counts(user_ids: set) -> dict:
+    """{(user_id, permission_id): count} for user_ids, including unflushed increments."""
+    while True:
+        flushes = usage_buffer.flushes
+        rows = await database.fetch_all(usage.select().where(usage.c.user_id.in_(user_ids)))
+        if flushes == usage_buffer.flushes:
+            break
+    counts = {(row['user_id'], row['permission_id']): row['count'] for row in rows}
+    for source in (usage_buffer.pending, usage_buffer.inflight):
+        for key, delta in source.items():
+            if key[0] in user_ids:
+                counts[key] = counts.get(key, 0) + delta
+    return counts
+
+async def ingest_usage_records(records: List[Optional[UsageRecord]]) -> List[dict]:
+    """Check a batch of usage records against plan limits and apply the accepted ones.
+
+    Policy for the whole batch is read with three set-based queries and current
+    usage with one more; records are then decided in order, each one seeing the
+    increments accepted before it. A record is accepted whole or not at all, with
+    the same reasons check_access gives. Accepted increments are applied in one
+    transaction (or handed to usage_buffer in write-behind mode).
+    """
+    valid = [r for r in records if r is not None]
+    user_ids = {r.user_id for r in valid}
+    endpoints = {r.endpoint for r in valid}
+    perm_ids, plan_of, limits = {}, {}, {}
+    if valid:
+        rows = await database.fetch_all(permissions.select().where(permissions.c.endpoint.in_(endpoints)))
+        perm_ids = {row['endpoint']: row['id'] for row in rows}
+        rows = await database.fetch_all(subscriptions.select().where(subscriptions.c.user_id.in_(user_ids)))
+        plan_of = {row['user_id']: row['plan_id'] for row in rows}
+        rows = await database.fetch_all(
+            plan_permissions.select().where(plan_permissions.c.plan_id.in_(set(plan_of.values())))
+        )
+        limits = {(row['plan_id'], row['permission_id']): row['limit'] for row in rows}
+
+    def decide(used):
+        results, deltas = [], {}
+        for record in records:
+            if record is None:
+                results.append({'accepted': False, 'reason': "Invalid record"})
+                continue
+            result = {'user_id': record.user_id, 'endpoint': record.endpoint, 'count': record.count}
+            perm_id = perm_ids.get(record.endpoint)
+            plan_id = plan_of.get(record.user_id)
+            key = (record.user_id, perm_id)
+            if perm_id is None:
+                reason = "Permission not found for endpoint"
+            elif plan_id is None:
+                reason = "No subscription"
+            elif (plan_id, perm_id) not in limits:
+                reason = "Endpoint not in plan permissions"
+            elif limits[(plan_id, perm_id)] is None or \
+                    used.get(key, 0) + deltas.get(key, 0) + record.count > limits[(plan_id, perm_id)]:
+                reason = "Usage limit reached"
+            else:
+                reason = None
+                deltas[key] = deltas.get(key, 0) + record.count
+            results.append(dict(result, accepted=reason is None, reason=reason))
+        return results, deltas
+
+    if not valid:
+        return decide({})[0]
+    if usage_buffer.enabled:
+        # no await between reading the counts and buffering the deltas
+        results, deltas = decide(await read_usage_counts(user_ids))
+        for key, delta in deltas.items():
+            usage_buffer.add(key, delta)
+        return results
+    for attempt in range(5):
+        try:
+            async with database.transaction():
+                results, deltas = decide(await read_usage_counts(user_ids))
+                if deltas:
+                    await apply_usage_deltas(deltas)
+            return results
+        except sqlite3.OperationalError:
+            # another writer committed between our read and write; decide again
+            if attempt == 4:
+                raise
+            await asyncio.sleep(0.01 * (attempt + 1))
+
+def _validate_usage_record(value) -> Optional[UsageRecord]:
+    try:
+        return UsageRecord(**value)
+    except (TypeError, ValueError):
+        return None
+
+@app.post("/usage/batch")
+async def record_usage_batch(request: Request):
+    """Record many (user_id, endpoint, count) records at once.
+
+    Accepts a JSON list (or {"records": [...]}) and answers with a per-record
+    result list. With an NDJSON content type the body is read as a stream and
+    the results are streamed back one line per record, so neither side is
+    buffered in memory.
+    """
+    if is_ndjson(request):
+        async def stream_results():
+            chunk, index = [], 0
+            async for value in iter_ndjson(request):
+                chunk.append(_validate_usage_record(value))
+                if len(chunk) >= USAGE_BATCH_CHUNK_SIZE:
+                    for result in await ingest_usage_records(chunk):
+                        yield json.dumps(dict(result, index=index)) + "\n"
+                        index += 1
+                    chunk = []
+            if chunk:
+                for result in await ingest_usage_records(chunk):
+                    yield json.dumps(dict(result, index=index)) + "\n"
+                    index += 1
+        return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+    try:
+        body = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Body must be a JSON list of usage records")
+    if isinstance(body, dict):
+        body = body.get("records")
+    if not isinstance(body, list):
+        raise HTTPException(status_code=400, detail="Body must be a JSON list of usage records")
+    results = []
+    for i in range(0, len(body), USAGE_BATCH_CHUNK_SIZE):
+        chunk = [_validate_usage_record(value) for value in body[i:i + USAGE_BATCH_CHUNK_SIZE]]
+        results.extend(await ingest_usage_records(chunk))
+    accepted = sum(1 for r in results if r['accepted'])
+    return {'accepted': accepted, 'rejected': len(results) - accepted, 'results': results}
+
 @app.post("/usage/{user_id}")
 async def record_usage(user_id: int, payload: UsageRequest):
-    allowed, reason = await check_access(user_id, payload.endpoint)
-    if not allowed:
+    reason, perm_id, limit = await authorize(user_id, payload.endpoint)
+    if reason:
         if reason == "No subscription":
             # user has no subscription
             raise HTTPException(status_code=404, detail="Subscription not found")
         # other reasons are forbidden
         raise HTTPException(status_code=403, detail=reason)
-    perm = await get_permission_by_endpoint(payload.endpoint)
-    await track_usage(user_id, perm['id'])
+    if not await track_usage(user_id, perm_id, limit):
+        raise HTTPException(status_code=403, detail="Usage limit reached")
     return {'status': 'recorded'}
 
 @app.get("/usage/{user_id}/limit")
@@ -332,6 +774,7 @@ async def limit_status(user_id: int):
             )
         )
         used = usage_row['count'] if usage_row else 0
+        used += usage_buffer.unflushed(user_id, row['permission_id'])
         result.append({'endpoint': perm['endpoint'], 'used': used, 'limit': row['limit']})
     return {'user_id': user_id, 'limits': result}
 
@@ -341,11 +784,11 @@ SERVICES = [f"service{i}" for i in range(1, 7)]
 async def call_service(service_name: str, user_id: int = Query(..., description="User ID making the call")):
     if service_name not in SERVICES:
         raise HTTPException(status_code=404, detail="Service not found")
-    allowed, reason = await check_access(user_id, service_name)
-    if not allowed:
+    reason, perm_id, limit = await authorize(user_id, service_name)
+    if reason:
         raise HTTPException(status_code=403, detail=reason)
-    perm = await get_permission_by_endpoint(service_name)
-    await track_usage(user_id, perm['id'])
+    if not await track_usage(user_id, perm_id, limit):
+        raise HTTPException(status_code=403, detail="Usage limit reached")
     return {'service': service_name, 'status': 'OK'}
 
 if __name__ == "__main__":
@@ -1,16 +1,19 @@
 import pytest
 import sys, os
+import asyncio
+import json
 from fastapi.testclient import TestClient
 
 # make sure main.py is importable
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from main import app, metadata, engine
+from main import app, metadata, engine, database, track_usage, policy_cache, usage_buffer
 
 @pytest.fixture(autouse=True)
 def reset_db():
     # recreate the database schema before each test
     metadata.drop_all(engine)
     metadata.create_all(engine)
+    policy_cache.clear()
     yield
     metadata.drop_all(engine)
 
@@ -167,4 +170,185 @@ def test_service_route_integration():
     # invalid service name
     res3 = client.get("/services/unknown", params={"user_id":31})
     assert res3.status_code == 404
-    print("Passed")
\ No newline at end of file
+    print("Passed")
+
+def test_access_decision_reasons():
+    print("Test 15: Testing access decision reasons")
+    perm = client.post("/permissions", json={"name":"p8","endpoint":"svc8","description":""}).json()["id"]
+    other = client.post("/permissions", json={"name":"p9","endpoint":"svc9","description":""}).json()["id"]
+    plan = client.post("/plans", json={"name":"PlanE","description":"","permission_ids":[perm],"limits":[1]}).json()["id"]
+    # unknown endpoint is a 404
+    assert client.get("/access/41/nope").status_code == 404
+    # no subscription yet
+    res = client.get("/access/41/svc8").json()
+    assert res["access"] is False and res["reason"] == "No subscription"
+    client.post("/subscriptions", json={"user_id":41,"plan_id":plan})
+    # permission outside the plan
+    res = client.get("/access/41/svc9").json()
+    assert res["access"] is False and res["reason"] == "Endpoint not in plan permissions"
+    # allowed until the limit is used up
+    assert client.get("/access/41/svc8").json()["access"] is True
+    client.post("/usage/41", json={"endpoint":"svc8"})
+    res = client.get("/access/41/svc8").json()
+    assert res["access"] is False and res["reason"] == "Usage limit reached"
+    print("Passed")
+
+def test_concurrent_usage_is_exact():
+    print("Test 16: Testing concurrent usage tracking is exact")
+    perm = client.post("/permissions", json={"name":"p10","endpoint":"svc10","description":""}).json()["id"]
+    capped = client.post("/plans", json={"name":"Capped","description":"","permission_ids":[perm],"limits":[1500]}).json()["id"]
+    roomy = client.post("/plans", json={"name":"Roomy","description":"","permission_ids":[perm],"limits":[10000]}).json()["id"]
+    client.post("/subscriptions", json={"user_id":51,"plan_id":capped})
+    client.post("/subscriptions", json={"user_id":52,"plan_id":roomy})
+    calls = 2000
+
+    async def hammer():
+        gate = asyncio.Semaphore(64)
+
+        async def one(user_id):
+            async with gate:
+                return await track_usage(user_id, perm)
+
+        await database.connect()
+        try:
+            return await asyncio.gather(*(one(uid) for uid in (51, 52) for _ in range(calls)))
+        finally:
+            await database.disconnect()
+
+    results = asyncio.run(hammer())
+    assert sum(results[:calls]) == 1500
+    assert sum(results[calls:]) == calls
+    counts = {u["endpoint"]: u["count"] for u in client.get("/subscriptions/51/usage").json()["usage"]}
+    assert counts == {"svc10": 1500}
+    counts = {u["endpoint"]: u["count"] for u in client.get("/subscriptions/52/usage").json()["usage"]}
+    assert counts == {"svc10": calls}
+    print("Passed")
+
+def test_policy_cache_hits_and_invalidation():
+    print("Test 17: Testing policy cache hits and invalidation")
+    perm = client.post("/permissions", json={"name":"p11","endpoint":"svc11","description":""}).json()["id"]
+    plan = client.post("/plans", json={"name":"PlanF","description":"","permission_ids":[perm],"limits":[5]}).json()["id"]
+    client.post("/subscriptions", json={"user_id":61,"plan_id":plan})
+    assert client.get("/access/61/svc11").json()["access"] is True
+    # warm path: every policy lookup is a hit
+    misses = policy_cache.misses
+    assert client.get("/access/61/svc11").json()["access"] is True
+    assert policy_cache.misses == misses and policy_cache.hits >= 3
+    # plan edits are visible immediately
+    client.put(f"/plans/{plan}", json={"permission_ids":[perm],"limits":[0]})
+    assert client.get("/access/61/svc11").json()["reason"] == "Usage limit reached"
+    # endpoint renames are visible immediately
+    client.put(f"/permissions/{perm}", json={"endpoint":"svc11-v2"})
+    assert client.get("/access/61/svc11").status_code == 404
+    assert client.get("/access/61/svc11-v2").status_code == 200
+    # subscription changes are visible immediately
+    other = client.post("/plans", json={"name":"PlanG","description":"","permission_ids":[perm],"limits":[5]}).json()["id"]
+    client.put("/subscriptions/61", json={"user_id":61,"plan_id":other})
+    assert client.get("/access/61/svc11-v2").json()["access"] is True
+    # deleting the permission drops it from cached plans
+    client.delete(f"/permissions/{perm}")
+    assert client.get("/access/61/svc11-v2").status_code == 404
+    print("Passed")
+
+def test_policy_cache_user_lru_is_bounded():
+    print("Test 18: Testing policy cache user map is bounded")
+    plan = client.post("/plans", json={"name":"PlanH","description":"","permission_ids":[],"limits":[]}).json()["id"]
+    saved = policy_cache.max_users
+    policy_cache.max_users = 3
+    try:
+        for uid in range(71, 76):
+            client.post("/subscriptions", json={"user_id":uid,"plan_id":plan})
+            asyncio.run(policy_cache.user_plan(uid))
+        assert list(policy_cache.users) == [73, 74, 75]
+    finally:
+        policy_cache.max_users = saved
+    print("Passed")
+
+def test_write_behind_usage_buffer():
+    print("Test 19: Testing write-behind usage buffer")
+    perm = client.post("/permissions", json={"name":"p12","endpoint":"service3","description":""}).json()["id"]
+    plan = client.post("/plans", json={"name":"PlanI","description":"","permission_ids":[perm],"limits":[300]}).json()["id"]
+    client.post("/subscriptions", json={"user_id":81,"plan_id":plan})
+    saved = usage_buffer.batch_size
+    usage_buffer.enabled, usage_buffer.batch_size = True, 100
+    try:
+        # unflushed increments count towards the limit
+        for _ in range(3):
+            assert client.get("/services/service3", params={"user_id":81}).status_code == 200
+        assert usage_buffer.unflushed(81, perm) == 3
+        assert client.get("/usage/81/limit").json()["limits"][0]["used"] == 3
+        assert client.get("/subscriptions/81/usage").json()["usage"] == [{"endpoint":"service3","count":3}]
+
+        async def burst():
+            await database.connect()
+            usage_buffer.start()
+            try:
+                results = await asyncio.gather(*(track_usage(81, perm) for _ in range(400)))
+                # the batch size wakes the flusher before the interval elapses
+                await asyncio.sleep(0.01)
+                assert usage_buffer.flushes >= 1
+            finally:
+                await usage_buffer.stop()
+                await database.disconnect()
+            return results
+
+        assert sum(asyncio.run(burst())) == 297
+        assert usage_buffer.stats()["pending"] == 0
+    finally:
+        usage_buffer.enabled, usage_buffer.batch_size = False, saved
+    # everything reached the database
+    assert client.get("/usage/81/limit").json()["limits"][0]["used"] == 300
+    assert client.get("/services/service3", params={"user_id":81}).status_code == 403
+    print("Passed")
+
+def test_usage_batch_matches_single_record_path():
+    print("Test 20: Testing bulk usage ingestion")
+    perm = client.post("/permissions", json={"name":"p13","endpoint":"svc13","description":""}).json()["id"]
+    other = client.post("/permissions", json={"name":"p14","endpoint":"svc14","description":""}).json()["id"]
+    plan = client.post("/plans", json={"name":"PlanJ","description":"","permission_ids":[perm],"limits":[5]}).json()["id"]
+    client.post("/subscriptions", json={"user_id":91,"plan_id":plan})
+    client.post("/usage/91", json={"endpoint":"svc13"})
+    records = [
+        {"user_id":91,"endpoint":"svc13","count":3},
+        {"user_id":91,"endpoint":"svc13","count":2},   # would make 6 > 5
+        {"user_id":91,"endpoint":"svc13"},             # count defaults to 1, makes 5
+        {"user_id":91,"endpoint":"svc14"},
+        {"user_id":92,"endpoint":"svc13"},
+        {"user_id":91,"endpoint":"nope"},
+        {"user_id":91,"endpoint":"svc13","count":0},
+    ]
+    res = client.post("/usage/batch", json=records)
+    assert res.status_code == 200
+    body = res.json()
+    assert [r["accepted"] for r in body["results"]] == [True, False, True, False, False, False, False]
+    assert [r["reason"] for r in body["results"]] == [
+        None, "Usage limit reached", None, "Endpoint not in plan permissions",
+        "No subscription", "Permission not found for endpoint", "Invalid record"]
+    assert body["accepted"] == 2 and body["rejected"] == 5
+    assert client.get("/usage/91/limit").json()["limits"][0]["used"] == 5
+    # the single-record path agrees the limit is used up
+    assert client.post("/usage/91", json={"endpoint":"svc13"}).status_code == 403
+    print("Passed")
+
+def test_usage_batch_ndjson_stream():
+    print("Test 21: Testing streamed NDJSON bulk usage ingestion")
+    perm = client.post("/permissions", json={"name":"p15","endpoint":"svc15","description":""}).json()["id"]
+    plan = client.post("/plans", json={"name":"PlanK","description":"","permission_ids":[perm],"limits":[2500]}).json()["id"]
+    for uid in (101, 102):
+        client.post("/subscriptions", json={"user_id":uid,"plan_id":plan})
+
+    def lines():
+        for i in range(3000):
+            yield (json.dumps({"user_id": 101 + i % 2, "endpoint": "svc15"}) + "\n").encode()
+        yield b"not json\n"
+
+    res = client.post("/usage/batch", content=lines(), headers={"content-type":"application/x-ndjson"})
+    assert res.status_code == 200
+    results = [json.loads(line) for line in res.text.splitlines()]
+    assert len(results) == 3001
+    assert [r["index"] for r in results] == list(range(3001))
+    assert sum(r["accepted"] for r in results) == 3000
+    assert results[-1]["reason"] == "Invalid record"
+    for uid in (101, 102):
+        assert client.get(f"/usage/{uid}/limit").json()["limits"][0]["used"] == 1500
+    print("Passed")